@@ -0,0 +1,11 @@
+import os
+
+# Settings shared by the webhook server and the ingest scripts
+MODEL_NAME = 'all-mpnet-base-v2'
+EMBEDDING_DIM = 768
+
+AUTH = ("", "")
+
+def memgraph_uri(default_host):
+    """Bolt URI for MEMGRAPH_HOST, falling back to the caller's default host."""
+    return f"bolt://{os.getenv('MEMGRAPH_HOST', default_host)}:7687"
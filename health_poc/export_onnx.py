@@ -0,0 +1,32 @@
+import os
+import logging
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+from config import MODEL_NAME
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODEL_ID = f"sentence-transformers/{MODEL_NAME}"
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(CURRENT_DIR, "onnx_model"))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ONNX-EXPORT")
+
+def export_onnx():
+    """One-time export of MPNet to ONNX with dynamic int8 quantization for CPU serving."""
+    logger.info(f"Exporting {MODEL_ID} to ONNX...")
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    model.save_pretrained(ONNX_MODEL_DIR)
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(ONNX_MODEL_DIR)
+
+    # Dynamic (weights-only) int8 - VNNI dot products on MatMul, no calibration data needed
+    logger.info("Quantizing to int8...")
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=ONNX_MODEL_DIR, quantization_config=qconfig)
+
+    logger.info(f"Done! Quantized model saved to {ONNX_MODEL_DIR}")
+
+if __name__ == "__main__":
+    export_onnx()
@@ -1,16 +1,17 @@
 import os
+import numpy as np
 from neo4j import GraphDatabase
 from sentence_transformers import SentenceTransformer
+from config import MODEL_NAME, AUTH, memgraph_uri
 
-URI = "bolt://localhost:7687" 
-AUTH = ("", "")
+URI = memgraph_uri("localhost")
 
-print("Loading AI Model (all-mpnet-base-v2)...")
-model = SentenceTransformer('all-mpnet-base-v2')
+print(f"Loading AI Model ({MODEL_NAME})...")
+model = SentenceTransformer(MODEL_NAME)
 print("Model Loaded.")
 
-def get_embedding(text):
-    return model.encode(text).tolist()
+def get_embeddings(texts):
+    return model.encode(texts, convert_to_numpy=True, normalize_embeddings=True).astype(np.float16).tolist()
 
 def ingest():
     driver = GraphDatabase.driver(URI, auth=AUTH)
@@ -28,7 +29,7 @@ def ingest():
         # Create index on :Description(embedding)
         session.run("""
             CREATE VECTOR INDEX snomed_description_index ON :Description(embedding) 
-            WITH CONFIG {"dimension": 768, "metric": "cos", "capacity": 10000}
+            WITH CONFIG {"dimension": 768, "metric": "ip", "capacity": 10000, "scalar_kind": "f16"}
         """)
 
         print("Injecting Clinical Concepts...")
@@ -77,12 +78,12 @@ def ingest():
         result = session.run("MATCH (d:Description) RETURN id(d) as id, d.term as term")
         nodes = list(result)
         
-        for node in nodes:
-            vector = get_embedding(node["term"])
-            session.run(
-                "MATCH (d:Description) WHERE id(d) = $id SET d.embedding = $vector",
-                id=node["id"], vector=vector
-            )
+        # One encode call and one write for every description
+        vectors = get_embeddings([node["term"] for node in nodes])
+        session.run(
+            "UNWIND $rows AS row MATCH (d:Description) WHERE id(d) = row.id SET d.embedding = row.vector",
+            rows=[{"id": node["id"], "vector": vector} for node, vector in zip(nodes, vectors)]
+        )
             
     print(f"Success! Ingested {len(nodes)} nodes with 768-dim embeddings.")
 
@@ -4,9 +4,18 @@ import sys
 import logging
 import gc
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, defaultdict
 import torch
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
 from neo4j import GraphDatabase
 from sentence_transformers import SentenceTransformer
+from config import MODEL_NAME, AUTH, memgraph_uri
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 BASE_PATH = os.path.join(os.path.dirname(CURRENT_DIR), "snomed")
@@ -15,22 +24,35 @@ CONCEPT_FILE = os.path.join(BASE_PATH, "sct2_Concept_MONOSnapshot_GB_20251217.tx
 DESC_FILE = os.path.join(BASE_PATH, "sct2_Description_MONOSnapshot-en_GB_20251217.txt")
 REL_FILE = os.path.join(BASE_PATH, "sct2_Relationship_MONOSnapshot_GB_20251217.txt")
 
-DB_HOST = os.getenv("MEMGRAPH_HOST", "localhost")
-MEMGRAPH_URI = f"bolt://{DB_HOST}:7687"
-AUTH = ("", "") 
+# Staging CSVs for LOAD CSV - the same folder must be mounted into the Memgraph container
+STAGING_DIR = os.path.join(BASE_PATH, "import")
+MEMGRAPH_STAGING_DIR = os.getenv("MEMGRAPH_IMPORT_DIR", "/snomed/import")
+
+MEMGRAPH_URI = memgraph_uri("localhost")
 
 #GPU SETUP
-# Reduced batch size to prevent silent crashes - embedding takes approx 1HR on a 4090 RTX
-BATCH_SIZE = 2048 
+# BATCH_SIZE sets the rows per Memgraph write, ENCODE_BATCH_SIZE the rows per forward pass (bounds VRAM)
+# SNOMED terms are short (~8-20 tokens) so FP16 mpnet fits 512 per pass comfortably on a 24GB card
+BATCH_SIZE = 8192
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "512"))
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# On CUDA every forward pass is padded to ENCODE_BATCH_SIZE rows and a multiple of SEQ_BUCKET tokens,
+# so the compiled model (and its CUDA graphs) only sees one shape per length bucket
+SEQ_BUCKET = 16
+# Rounds embeddings to half precision before the write. Bolt still carries them as 64-bit floats
+# (Memgraph has no byte-array property), so the memory saving comes from the index's scalar_kind "f16"
+EMBEDDING_DTYPE = np.float16
+# Rows per commit inside each LOAD CSV (USING PERIODIC COMMIT, Memgraph 2.21+) - bounds the delta memory
+LOAD_CSV_COMMIT_SIZE = 50000
+# Encoded batches allowed to queue up ahead of the Memgraph writer
+PIPELINE_DEPTH = 4
+# Most queued batches committed together in one write transaction
+TX_BATCHES = 8
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("SNOMED-FINAL")
 sys.stdout.reconfigure(line_buffering=True) # Force instant printing
 
-try: csv.field_size_limit(sys.maxsize)
-except OverflowError: csv.field_size_limit(2147483647) 
-
 def check_files():
     """Verifies all files exist before starting."""
     missing = False
@@ -44,11 +66,135 @@ def check_files():
         logger.error("Aborting due to missing files.")
         sys.exit(1)
 
-def load_csv(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
-        for row in reader:
-            yield row
+def active_batches(file_path, columns):
+    """Streams the active rows of a SNOMED RF2 file as pyarrow record batches of the requested columns.
+    Parsing and the active filter run inside pyarrow, so inactive rows never reach Python."""
+    reader = pa_csv.open_csv(
+        file_path,
+        parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=['active', *columns],
+            column_types={'active': pa.int8(), **{c: pa.string() for c in columns}}
+        )
+    )
+    for batch in reader:
+        yield batch.filter(pc.equal(batch.column('active'), 1))
+
+def load_active(file_path, columns, concept_ids=None):
+    """Same rows as active_batches, as namedtuples for the loops that need them in Python.
+    With concept_ids, rows whose conceptId is not in it are dropped in pyarrow as well."""
+    Row = namedtuple('Row', columns)
+    for batch in active_batches(file_path, columns):
+        if concept_ids is not None:
+            batch = batch.filter(pc.is_in(batch.column('conceptId'), value_set=concept_ids))
+        yield from map(Row._make, zip(*(batch.column(c).to_pylist() for c in columns)))
+
+def staging_paths(name):
+    """Returns the local path to write a staging CSV to and the path Memgraph reads it from."""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    return os.path.join(STAGING_DIR, name), f"{MEMGRAPH_STAGING_DIR}/{name}"
+
+def stage_relationships():
+    """Writes active relationships to the IS_A and ASSOCIATED_WITH staging CSVs.
+    Stays columnar end to end - no per-relationship Python objects are built."""
+    count = 0
+    rels_map = {"116680003": "IS_A", "47429007": "ASSOCIATED_WITH", "42752001": "DUE_TO", "246090004": "ASSOCIATED_FINDING"}
+    rel_types = pa.array(list(rels_map))
+    schema = pa.schema([("source", pa.string()), ("dest", pa.string())])
+    isa_path, isa_csv = staging_paths("rels_isa.csv")
+    assoc_path, assoc_csv = staging_paths("rels_assoc.csv")
+
+    with pa_csv.CSVWriter(isa_path, schema) as writer_isa, pa_csv.CSVWriter(assoc_path, schema) as writer_assoc:
+        for batch in active_batches(REL_FILE, ['sourceId', 'destinationId', 'typeId']):
+            batch = batch.filter(pc.is_in(batch.column('typeId'), value_set=rel_types))
+            is_isa = pc.equal(batch.column('typeId'), "116680003")
+            pairs = pa.RecordBatch.from_arrays([batch.column('sourceId'), batch.column('destinationId')], schema=schema)
+
+            writer_isa.write_batch(pairs.filter(is_isa))
+            writer_assoc.write_batch(pairs.filter(pc.invert(is_isa)))
+            count += batch.num_rows
+
+    return isa_csv, assoc_csv, count
+
+def embed_terms(model, terms):
+    """Runs MPNet directly instead of model.encode: int32 ids through pinned memory, then mean pooling
+    and L2 normalisation on the device (the same pooling all-mpnet-base-v2 ships with)."""
+    n = len(terms)
+    pad_to = None
+    if DEVICE == 'cuda':
+        terms = terms + [""] * (ENCODE_BATCH_SIZE - n)
+        pad_to = SEQ_BUCKET
+    tok = model.tokenizer(terms, padding=True, truncation=True, max_length=model.max_seq_length,
+                          pad_to_multiple_of=pad_to, return_tensors='pt')
+    input_ids = tok['input_ids'].to(torch.int32)
+    attention_mask = tok['attention_mask'].to(torch.int32)
+    if DEVICE == 'cuda':
+        input_ids = input_ids.pin_memory().to(DEVICE, non_blocking=True)
+        attention_mask = attention_mask.pin_memory().to(DEVICE, non_blocking=True)
+
+    token_embeddings = model[0].auto_model(input_ids=input_ids, attention_mask=attention_mask)[0].float()
+    mask = attention_mask.unsqueeze(-1).float()
+    pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+    return torch.nn.functional.normalize(pooled[:n], p=2, dim=1)
+
+def encode_worker(model, items, q_write):
+    """Encodes description batches on the GPU and queues them for the writer as column lists
+    plus the row positions belonging to each parent concept."""
+    try:
+        for start in range(0, len(items), BATCH_SIZE):
+            ids, cids, terms, types = map(list, zip(*items[start:start + BATCH_SIZE]))
+
+            # Repeated synonyms are encoded once and fanned back out
+            uniq_idx = {term: i for i, term in enumerate(dict.fromkeys(terms))}
+
+            # inference_mode/autocast are thread-local, so they have to be entered in this thread
+            with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=torch.float16, enabled=DEVICE == 'cuda'):
+                uniq_terms = list(uniq_idx)
+                uniq_vecs = torch.cat([
+                    embed_terms(model, uniq_terms[i:i + ENCODE_BATCH_SIZE])
+                    for i in range(0, len(uniq_terms), ENCODE_BATCH_SIZE)
+                ]).cpu().numpy()
+            vectors = uniq_vecs[[uniq_idx[term] for term in terms]]
+
+            # Row positions per concept, so the writer probes each parent concept once
+            groups = defaultdict(list)
+            for i, cid in enumerate(cids):
+                groups[cid].append(i)
+
+            q_write.put({
+                "ids": ids,
+                "cids": list(groups),
+                "rows": list(groups.values()),
+                "terms": terms,
+                "types": types,
+                # Memgraph has no byte-array property type, so vectors travel as float lists;
+                # FP16 storage savings come from the index's scalar_kind instead
+                "vecs": vectors.astype(EMBEDDING_DTYPE).tolist()
+            })
+    except Exception as e:
+        q_write.put(e)
+    finally:
+        q_write.put(None)
+
+def write_descriptions(tx, batches):
+    """Creates the descriptions for several encoded batches inside one transaction
+    and returns how many were created."""
+    created = 0
+    for batch in batches:
+        created += tx.run("""
+            UNWIND range(0, size($cids) - 1) AS g
+            MATCH (c:Concept {sctid: $cids[g]})
+            UNWIND $rows[g] AS i
+            CREATE (d:Description {
+                sctid: $ids[i], 
+                term: $terms[i], 
+                type: $types[i],
+                embedding: $vecs[i]
+            })
+            CREATE (c)-[:HAS_DESCRIPTION]->(d)
+            RETURN count(d) AS created
+        """, **batch).single()["created"]
+    return created
 
 def nuke_database(session):
     """Clears database and drops indexes safely."""
@@ -75,7 +221,11 @@ def ingest_snomed():
     check_files()
 
     logger.info("Loading AI Model...")
-    model = SentenceTransformer('all-mpnet-base-v2', device=DEVICE)
+    model = SentenceTransformer(MODEL_NAME, device=DEVICE)
+    if DEVICE == 'cuda':
+        model.half()
+        # Long batch run - worth paying max-autotune's compile time once per SEQ_BUCKET shape
+        model[0].auto_model = torch.compile(model[0].auto_model, mode='max-autotune', fullgraph=False)
     logger.info("Model Loaded.")
 
     driver = GraphDatabase.driver(MEMGRAPH_URI, auth=AUTH)
@@ -85,129 +235,97 @@ def ingest_snomed():
         logger.info("Creating Indexes...")
         session.run("CREATE INDEX ON :Concept(sctid)")
         session.run("CREATE INDEX ON :Description(sctid)")
+        # Created empty up front so descriptions are indexed as they are written, not in one build at the end
+        # Embeddings are L2-normalised, so inner product ranks exactly like cosine without the norm work
+        session.run("""
+            CREATE VECTOR INDEX snomed_description_index ON :Description(embedding) 
+            WITH CONFIG {"dimension": 768, "metric": "ip", "capacity": 1000000, "scalar_kind": "f16"}
+        """)
+
+    # Relationship staging doesn't depend on the graph, so it runs alongside Steps 2 and 3
+    staging_pool = ThreadPoolExecutor(max_workers=1)
+    rels_staged = staging_pool.submit(stage_relationships)
 
     logger.info("Step 2: Loading Concepts...")
+    count = 0
+    concepts_path, concepts_csv = staging_paths("concepts.csv")
+    active_ids = []
+
+    with open(concepts_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["sctid"])
+        for row in load_active(CONCEPT_FILE, ['id']):
+            writer.writerow([row.id])
+            active_ids.append(row.id)
+            count += 1
+    concept_ids = pa.array(active_ids, type=pa.string())
+    del active_ids
+
     with driver.session() as session:
-        batch = []
-        count = 0
-        loaded_ids = set()
-        
-        for row in load_csv(CONCEPT_FILE):
-            if row['active'] == '1':
-                batch.append({"sctid": row['id']})
-                loaded_ids.add(row['id'])
-            
-            if len(batch) >= BATCH_SIZE:
-                session.run("UNWIND $batch as row MERGE (:Concept {sctid: row.sctid})", batch=batch)
-                count += len(batch)
-                batch = []
-                print(f"   Saved {count} concepts...", end='\r')
-        
-        if batch:
-            session.run("UNWIND $batch as row MERGE (:Concept {sctid: row.sctid})", batch=batch)
-        print(f"Concepts Done. Total Active: {len(loaded_ids)}")
+        session.run(f"USING PERIODIC COMMIT {LOAD_CSV_COMMIT_SIZE} LOAD CSV FROM '{concepts_csv}' WITH HEADER AS row CREATE (:Concept {{sctid: row.sctid}})")
+    print(f"Concepts Done. Total Active: {count}")
 
     logger.info("Step 3: Descriptions & Embeddings...")
-    batch = []
+    # Descriptions of inactive concepts are dropped before they are sorted or encoded
+    items = list(load_active(DESC_FILE, ['id', 'conceptId', 'term', 'typeId'], concept_ids=concept_ids))
+    del concept_ids
+
+    # Smart batching - sorting by term length means each batch only pads to its local max,
+    # and the secondary sort on term keeps duplicate terms in the same batch for dedup
+    items.sort(key=lambda row: (len(row.term), row.term))
     count = 0
-    
+
+    # Encoding runs in its own thread so the GPU keeps working during Memgraph writes
+    q_write = queue.Queue(maxsize=PIPELINE_DEPTH)
+    encoder = threading.Thread(target=encode_worker, args=(model, items, q_write), daemon=True)
+    encoder.start()
+
     with driver.session() as session:
-        for row in load_csv(DESC_FILE):
-            if row['active'] == '1' and row['conceptId'] in loaded_ids:
-                batch.append({
-                    "id": row['id'],
-                    "conceptId": row['conceptId'],
-                    "term": row['term'],
-                    "typeId": row['typeId'] 
-                })
-
-            if len(batch) >= BATCH_SIZE:
+        done = False
+        while not done:
+            # Block for one batch, then take whatever else is already queued so commits are shared
+            batches = [q_write.get()]
+            while len(batches) < TX_BATCHES and batches[-1] is not None:
                 try:
-                   
-                    terms = [item['term'] for item in batch]
-                    vectors = model.encode(terms, batch_size=BATCH_SIZE, show_progress_bar=False).tolist()
-
-                    for i, item in enumerate(batch):
-                        item['embedding'] = vectors[i]
-
-                    session.run("""
-                        UNWIND $batch as row
-                        MATCH (c:Concept {sctid: row.conceptId})
-                        CREATE (d:Description {
-                            sctid: row.id, 
-                            term: row.term, 
-                            type: row.typeId,
-                            embedding: row.embedding
-                        })
-                        CREATE (c)-[:HAS_DESCRIPTION]->(d)
-                    """, batch=batch)
-                    
-                    count += len(batch)
-                    batch = []
-                    print(f"Embedded & Saved {count} descriptions...", end='\r')
-
-
-                    del terms
-                    del vectors
-                    # torch.cuda.empty_cache() 
-
-                except Exception as e:
-                    print(f"CRASH in Step 3: {e}")
-
-                    sys.exit(1)
-
-        # Flush final batch
-        if batch:
-            terms = [item['term'] for item in batch]
-            vectors = model.encode(terms).tolist()
-            for i, item in enumerate(batch):
-                item['embedding'] = vectors[i]
-            session.run("""
-                UNWIND $batch as row
-                MATCH (c:Concept {sctid: row.conceptId})
-                CREATE (d:Description {sctid: row.id, term: row.term, type: row.typeId, embedding: row.embedding})
-                CREATE (c)-[:HAS_DESCRIPTION]->(d)
-            """, batch=batch)
-            
-    print(f"Descriptions Done: {count + len(batch)}")
+                    batches.append(q_write.get_nowait())
+                except queue.Empty:
+                    break
+            if batches[-1] is None:
+                batches.pop()
+                done = True
+
+            try:
+                for batch in batches:
+                    if isinstance(batch, Exception):
+                        raise batch
+
+                if batches:
+                    count += session.execute_write(write_descriptions, batches)
+
+                print(f"Embedded & Saved {count} descriptions...", end='\r')
+
+                del batches
+                # torch.cuda.empty_cache() 
+
+            except Exception as e:
+                print(f"CRASH in Step 3: {e}")
+
+                sys.exit(1)
+
+    encoder.join()
+    del items
+    print(f"Descriptions Done: {count}")
 
     logger.info("Step 4: Relationships...")
+    isa_csv, assoc_csv, count = rels_staged.result()
+    staging_pool.shutdown()
+
+    # Both MATCH lookups use the :Concept(sctid) index created above and skip inactive endpoints
     with driver.session() as session:
-        batch_isa = []
-        batch_assoc = []
-        count = 0
-        rels_map = {"116680003": "IS_A", "47429007": "ASSOCIATED_WITH", "42752001": "DUE_TO", "246090004": "ASSOCIATED_FINDING"}
-        
-        for row in load_csv(REL_FILE):
-            if row['active'] == '1' and row['typeId'] in rels_map:
-                if row['sourceId'] in loaded_ids and row['destinationId'] in loaded_ids:
-                    item = {"source": row['sourceId'], "dest": row['destinationId']}
-                    if row['typeId'] == "116680003":
-                        batch_isa.append(item)
-                    else:
-                        batch_assoc.append(item)
-            
-            if len(batch_isa) >= BATCH_SIZE:
-                session.run("UNWIND $batch as row MATCH (a:Concept {sctid: row.source}), (b:Concept {sctid: row.dest}) MERGE (a)-[:IS_A]->(b)", batch=batch_isa)
-                count += len(batch_isa)
-                batch_isa = []
-                print(f"   Saved {count} relationships...", end='\r')
-
-            if len(batch_assoc) >= BATCH_SIZE:
-                session.run("UNWIND $batch as row MATCH (a:Concept {sctid: row.source}), (b:Concept {sctid: row.dest}) MERGE (a)-[:ASSOCIATED_WITH]->(b)", batch=batch_assoc)
-                count += len(batch_assoc)
-                batch_assoc = []
-                print(f"   Saved {count} relationships...", end='\r')
-
-        if batch_isa: session.run("UNWIND $batch as row MATCH (a:Concept {sctid: row.source}), (b:Concept {sctid: row.dest}) MERGE (a)-[:IS_A]->(b)", batch=batch_isa)
-        if batch_assoc: session.run("UNWIND $batch as row MATCH (a:Concept {sctid: row.source}), (b:Concept {sctid: row.dest}) MERGE (a)-[:ASSOCIATED_WITH]->(b)", batch=batch_assoc)
-
-    logger.info("Step 5: Building Vector Index...")
-    with driver.session() as session:
-        session.run("""
-            CREATE VECTOR INDEX snomed_description_index ON :Description(embedding) 
-            WITH CONFIG {"dimension": 768, "metric": "cos", "capacity": 1000000}
-        """)
+        session.run(f"USING PERIODIC COMMIT {LOAD_CSV_COMMIT_SIZE} LOAD CSV FROM '{isa_csv}' WITH HEADER AS row MATCH (a:Concept {{sctid: row.source}}), (b:Concept {{sctid: row.dest}}) MERGE (a)-[:IS_A]->(b)")
+        session.run(f"USING PERIODIC COMMIT {LOAD_CSV_COMMIT_SIZE} LOAD CSV FROM '{assoc_csv}' WITH HEADER AS row MATCH (a:Concept {{sctid: row.source}}), (b:Concept {{sctid: row.dest}}) MERGE (a)-[:ASSOCIATED_WITH]->(b)")
+    print(f"Relationships Done: {count}")
+
     logger.info("Done!")
 
 if __name__ == "__main__":
@@ -1,72 +1,509 @@
 import os
 import logging
-import json
-import traceback
+import orjson
+import time
+import queue
+import atexit
+import importlib.util
+import asyncio
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from neo4j import GraphDatabase
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from neo4j import AsyncGraphDatabase, AsyncResult, RoutingControl
+from config import MODEL_NAME, EMBEDDING_DIM, AUTH, memgraph_uri
+from transformers import AutoTokenizer
+import onnxruntime as ort
 
 # --- CONFIGURATION ---
-app = FastAPI()
-logging.basicConfig(level=logging.INFO)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueues the raw record so formatting (and traceback rendering) happens on the listener thread"""
+    def prepare(self, record):
+        return record
+
+# Request handlers only enqueue records; the listener thread formats and writes them to stderr
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_handler)
+# Started at import so records from import time and the uvicorn supervisor process are written too;
+# stopped at exit to flush whatever is still queued
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(level=logging.INFO, handlers=[DeferredQueueHandler(log_queue)])
 logger = logging.getLogger("Triage-FastAPI")
 
 # Database Connection
-DB_HOST = os.getenv("MEMGRAPH_HOST", "health_memgraph")
-MEMGRAPH_URI = f"bolt://{DB_HOST}:7687"
-AUTH = ("", "") 
+MEMGRAPH_URI = memgraph_uri("health_memgraph")
+MG_POOL = int(os.getenv("MG_POOL", "64"))
+MG_ACQ_TIMEOUT = float(os.getenv("MG_ACQ_TIMEOUT", "30"))  # seconds
+MG_MAX_LIFETIME = float(os.getenv("MG_MAX_LIFETIME", "3600"))  # seconds
 
-# --- LOAD AI MODEL ---
-logger.info("Loading AI Model...")
-device = 'cuda' if os.getenv("USE_GPU", "false").lower() == "true" else 'cpu'
+# Query batching - concurrent symptoms arriving within the window share one forward pass
+ENCODE_MAX_BATCH = 32
+ENCODE_MAX_WAIT = 0.005  # seconds
+
+# Result caches - exact repeats skip the model and the DB, near-paraphrases (cosine >= threshold) skip the DB
+EXACT_CACHE_SIZE = 4096
+SEMANTIC_CACHE_SIZE = 10_000
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# CPU serving uses the int8 ONNX export from export_onnx.py when it exists
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(CURRENT_DIR, "onnx_model"))
+ONNX_MODEL_FILE = os.path.join(ONNX_MODEL_DIR, "model_quantized.onnx")
+MAX_SEQ_LENGTH = 128  # symptoms are a few words; padding stays dynamic so short queries stay short
+# One uvicorn worker process per core by default; each loads its own model
+CPU_COUNT = os.cpu_count() or 1
 try:
-    model = SentenceTransformer('all-mpnet-base-v2', device=device)
-    logger.info(f"Model Ready on {device.upper()}.")
-except Exception as e:
-    logger.error(f"Failed to load model: {e}")
-    exit(1)
+    WORKERS = max(1, int(os.getenv("WORKERS") or CPU_COUNT))
+except ValueError:
+    logger.warning(f"Invalid WORKERS={os.getenv('WORKERS')!r}, using 1.")
+    WORKERS = 1
+# Split the cores between uvicorn workers so their intra-op thread pools don't oversubscribe
+ENCODE_THREADS = max(1, CPU_COUNT // WORKERS)
+
+# In-process HNSW copy of the description embeddings - top-k without a Bolt round-trip per query
+USE_ANN_INDEX = os.getenv("USE_ANN_INDEX", "false").lower() == "true"
+ANN_RELOAD_INTERVAL = float(os.getenv("ANN_RELOAD_INTERVAL", "0"))  # seconds, 0 = load once at startup
+# Built by one worker and saved here; the other workers load the file instead of pulling the corpus
+ANN_INDEX_FILE = os.getenv("ANN_INDEX_FILE", os.path.join(CURRENT_DIR, "ann_index.bin"))
+ANN_LOCK_FILE = ANN_INDEX_FILE + ".lock"
+ANN_LOCK_TIMEOUT = 7200  # seconds before a build lock left behind by a dead worker is ignored
+ANN_POLL_INTERVAL = 5  # seconds between checks while another worker builds
+# The corpus may have been re-ingested since, so index files saved before this run are stale;
+# __main__ stamps the launch time so all workers agree on it
+ANN_EPOCH = float(os.getenv("ANN_EPOCH", time.time()))
+ANN_M = 32
+ANN_EF_CONSTRUCTION = 200
+ANN_EF_SEARCH = 64
+
+# --- AI MODEL ---
+device = 'cuda' if os.getenv("USE_GPU", "false").lower() == "true" else 'cpu'
+model = None
+tokenizer = None
+ort_session = None
+
+def load_model():
+    """Loads the int8 ONNX model on CPU when exported, otherwise the PyTorch SentenceTransformer"""
+    global model, tokenizer, ort_session
+    logger.info("Loading AI Model...")
+    if device == 'cpu' and os.path.exists(ONNX_MODEL_FILE):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = ENCODE_THREADS
+        tokenizer = AutoTokenizer.from_pretrained(ONNX_MODEL_DIR)
+        ort_session = ort.InferenceSession(ONNX_MODEL_FILE, options, providers=['CPUExecutionProvider'])
+        logger.info("Model Ready on CPU (ONNX Runtime int8).")
+    else:
+        if device == 'cpu':
+            logger.warning(f"No ONNX model at {ONNX_MODEL_FILE}, falling back to PyTorch. Run export_onnx.py to create it.")
+        # Imported here so the ONNX path never pays for loading torch/sentence-transformers
+        import torch
+        from sentence_transformers import SentenceTransformer
+        torch.set_num_threads(ENCODE_THREADS)
+        model = SentenceTransformer(MODEL_NAME, device=device)
+        if device == 'cuda':
+            # Default mode (no CUDA graphs): request batches of 1..ENCODE_MAX_BATCH rows and any length
+            # would record a graph per shape; dynamic=True keeps it to one compiled kernel set
+            model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True, fullgraph=False)
+        logger.info(f"Model Ready on {device.upper()}.")
+
+# Async driver so Memgraph round-trips yield to the event loop; built in lifespan inside the running loop
+driver = None
+
+def encode_texts(texts):
+    """Returns unit-length embeddings for texts from ONNX Runtime, or the torch model when it is loaded"""
+    if model is not None:
+        return model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+
+    # Mean pooling + L2 normalisation, the same head all-mpnet-base-v2 ships with in sentence-transformers
+    enc = tokenizer(texts, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors='np')
+    feeds = {i.name: enc[i.name].astype(np.int64) for i in ort_session.get_inputs()}
+    token_embeddings = ort_session.run(None, feeds)[0]
+    mask = enc['attention_mask'][..., None].astype(np.float32)
+    pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+# --- EMBEDDING BATCHER ---
+encode_queue = None
+encoder_task = None
+# One dedicated encode thread - the model's intra-op threads already parallelise each batch
+encode_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encode")
+
+async def encoder_loop():
+    """Collects queued symptoms for up to ENCODE_MAX_WAIT and encodes them in one call"""
+    loop = asyncio.get_running_loop()
+    while True:
+        text, fut = await encode_queue.get()
+        texts, futs = [text], [fut]
+        deadline = loop.time() + ENCODE_MAX_WAIT
+
+        while len(texts) < ENCODE_MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                text, fut = await asyncio.wait_for(encode_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            texts.append(text)
+            futs.append(fut)
+
+        try:
+            vectors = await loop.run_in_executor(encode_pool, encode_texts, texts)
+        except Exception as e:
+            for fut in futs:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        # Rows stay float32 numpy - the semantic cache uses them as-is and the driver packs them for Bolt
+        for fut, vector in zip(futs, vectors.astype(np.float32, copy=False)):
+            if not fut.done():
+                fut.set_result(vector)
+
+async def warm_up():
+    """Runs a small encode batch and opens the first Bolt connection concurrently before serving,
+    so the first request pays neither compile/allocator costs nor the connection handshake"""
+    loop = asyncio.get_running_loop()
+    warm, db = await asyncio.gather(
+        loop.run_in_executor(encode_pool, encode_texts, ["warmup"] * 8),
+        driver.verify_connectivity(),
+        return_exceptions=True
+    )
+    if isinstance(warm, Exception):
+        raise warm
+    if isinstance(db, Exception):
+        logger.warning(f"Memgraph not reachable at startup: {db}")
+
+# --- ANN INDEX ---
+ann_index = None
+ann_task = None
+
+ANN_COUNT_QUERY = "MATCH (d:Description) WHERE d.sctid IS NOT NULL RETURN count(d) AS n"
+# Labels are description SCTIDs (numeric, < 2^63) - stable across re-ingests, unlike internal node ids
+ANN_LOAD_QUERY = "MATCH (d:Description) WHERE d.sctid IS NOT NULL RETURN d.sctid AS id, d.embedding AS embedding"
+
+async def fetch_embeddings():
+    """Streams every Description embedding into preallocated arrays - float32 rows rather than
+    a Python list of boxed floats per description, which would be ~8x the final size"""
+    async with driver.session(default_access_mode="READ") as session:
+        n = (await (await session.run(ANN_COUNT_QUERY)).single())["n"]
+        ids = np.empty(n, dtype=np.int64)
+        vectors = np.empty((n, EMBEDDING_DIM), dtype=np.float32)
+        result = await session.run(ANN_LOAD_QUERY)
+        i = 0
+        async for record in result:
+            if i == n:
+                break  # written since the count; picked up by the next reload
+            ids[i] = int(record["id"])
+            vectors[i] = record["embedding"]
+            i += 1
+    return ids[:i], vectors[:i]
+
+def build_ann_index(ids, vectors):
+    """Builds the HNSW graph over the unit-length embeddings (inner product == cosine here)
+    and saves it for the other workers; the rename keeps readers off a half-written file"""
+    import hnswlib
+    index = hnswlib.Index(space='ip', dim=EMBEDDING_DIM)
+    index.init_index(max_elements=len(ids), M=ANN_M, ef_construction=ANN_EF_CONSTRUCTION)
+    index.add_items(vectors, ids, num_threads=ENCODE_THREADS)
+    index.set_ef(ANN_EF_SEARCH)
+    index.save_index(ANN_INDEX_FILE + ".tmp")
+    os.replace(ANN_INDEX_FILE + ".tmp", ANN_INDEX_FILE)
+    return index
+
+def read_ann_index():
+    import hnswlib
+    index = hnswlib.Index(space='ip', dim=EMBEDDING_DIM)
+    index.load_index(ANN_INDEX_FILE)
+    index.set_ef(ANN_EF_SEARCH)
+    return index
+
+def ann_index_file_is_fresh():
+    """True when the saved index was built during this run and within ANN_RELOAD_INTERVAL"""
+    try:
+        mtime = os.path.getmtime(ANN_INDEX_FILE)
+    except OSError:
+        return False
+    if ANN_RELOAD_INTERVAL > 0 and time.time() - mtime >= ANN_RELOAD_INTERVAL:
+        return False
+    return mtime >= ANN_EPOCH
+
+def claim_ann_build():
+    """Atomically creates the lock file so only one worker builds at a time"""
+    try:
+        if time.time() - os.path.getmtime(ANN_LOCK_FILE) > ANN_LOCK_TIMEOUT:
+            os.remove(ANN_LOCK_FILE)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(ANN_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+async def load_ann_index():
+    """Loads the saved index if it is fresh, otherwise builds it (or waits while another worker
+    does) and swaps it in"""
+    global ann_index
+    # hnswlib load/build run on the default executor so the encode thread keeps serving
+    loop = asyncio.get_running_loop()
+    while True:
+        if ann_index_file_is_fresh():
+            index = await loop.run_in_executor(None, read_ann_index)
+            break
+        if claim_ann_build():
+            try:
+                logger.info("Loading description embeddings for the ANN index...")
+                ids, vectors = await fetch_embeddings()
+                if len(ids) == 0:
+                    logger.warning("No descriptions in Memgraph - ANN index not built, using vector_search.")
+                    return
+                index = await loop.run_in_executor(None, build_ann_index, ids, vectors)
+                del ids, vectors
+            finally:
+                os.remove(ANN_LOCK_FILE)
+            break
+        await asyncio.sleep(ANN_POLL_INTERVAL)
+
+    ann_index = index
+    logger.info(f"ANN index ready ({index.get_current_count()} descriptions).")
+
+async def ann_index_loop():
+    """Builds the index in the background, then rebuilds it every ANN_RELOAD_INTERVAL to pick up re-ingests"""
+    while True:
+        try:
+            await load_ann_index()
+        except Exception as e:
+            logger.error(f"ANN index load failed, using vector_search: {e}")
+        if ANN_RELOAD_INTERVAL <= 0:
+            return
+        await asyncio.sleep(ANN_RELOAD_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app):
+    """Loads the model and opens Memgraph before traffic is accepted; closes both on shutdown"""
+    global driver, encode_queue, encoder_task, ann_task
+    try:
+        load_model()
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}")
+        raise
+
+    driver = AsyncGraphDatabase.driver(
+        MEMGRAPH_URI,
+        auth=AUTH,
+        max_connection_pool_size=MG_POOL,
+        connection_acquisition_timeout=MG_ACQ_TIMEOUT,
+        max_connection_lifetime=MG_MAX_LIFETIME,
+        keep_alive=True
+    )
+    encode_queue = asyncio.Queue()
+    encoder_task = asyncio.create_task(encoder_loop())
+    await warm_up()
+    # Requests go to Memgraph's vector_search until the index is ready
+    if USE_ANN_INDEX:
+        ann_task = asyncio.create_task(ann_index_loop())
 
-driver = GraphDatabase.driver(MEMGRAPH_URI, auth=AUTH)
+    yield
+
+    if ann_task is not None:
+        ann_task.cancel()
+    encoder_task.cancel()
+    await driver.close()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+async def get_embedding(text):
+    """Queues text for the next encode batch and waits for its vector"""
+    fut = asyncio.get_running_loop().create_future()
+    await encode_queue.put((text, fut))
+    return await fut
+
+# --- RESULT CACHES ---
+cache_lock = threading.Lock()
+exact_cache = OrderedDict()
+# Ring buffer of unit-length query vectors; cosine against all of them is a single GEMV
+semantic_vecs = np.zeros((SEMANTIC_CACHE_SIZE, EMBEDDING_DIM), dtype=np.float32)
+semantic_results = [None] * SEMANTIC_CACHE_SIZE
+semantic_count = 0
+
+def exact_cache_get(key):
+    with cache_lock:
+        if key in exact_cache:
+            exact_cache.move_to_end(key)
+            return exact_cache[key]
+    return None
+
+def semantic_cache_get(vector):
+    """Returns the candidates of the closest cached query if it is within SEMANTIC_CACHE_THRESHOLD"""
+    with cache_lock:
+        n = min(semantic_count, SEMANTIC_CACHE_SIZE)
+    if n == 0:
+        return None
+    # The scan runs without the lock so exact_cache_get/cache_put on the event loop never wait on it;
+    # a slot overwritten mid-scan is caught by re-checking the winner under the lock
+    sims = semantic_vecs[:n] @ vector
+    best = int(sims.argmax())
+    if sims[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    with cache_lock:
+        if semantic_vecs[best] @ vector >= SEMANTIC_CACHE_THRESHOLD:
+            return semantic_results[best]
+    return None
+
+def cache_put(key, vector, candidates):
+    """Stores results in both caches; the semantic cache evicts FIFO once full"""
+    global semantic_count
+    with cache_lock:
+        exact_cache[key] = candidates
+        if len(exact_cache) > EXACT_CACHE_SIZE:
+            exact_cache.popitem(last=False)
+
+        slot = semantic_count % SEMANTIC_CACHE_SIZE
+        semantic_vecs[slot] = vector
+        semantic_results[slot] = candidates
+        semantic_count += 1
 
 # --- SEARCH LOGIC ---
-def lookup_symptom(symptom_text):
+LOOKUP_K = 10
+STREAM_MAX_K = 200  # cap on the k a manual request can ask for
+# k is a parameter too, so every top-k shares one query string (and one driver/planner cache entry)
+QUERY = """
+CALL vector_search.search('snomed_description_index', $k, $embedding) 
+YIELD node, similarity 
+MATCH (c:Concept)-[:HAS_DESCRIPTION]->(node)
+RETURN c.sctid AS id, node.term AS term, similarity AS score 
+ORDER BY score DESC
+"""
+
+# Resolves in-process ANN hits (Description SCTIDs) to their Concepts in one round-trip
+ANN_RESOLVE_QUERY = """
+UNWIND $hits AS hit
+MATCH (node:Description {sctid: hit.id})
+MATCH (c:Concept)-[:HAS_DESCRIPTION]->(node)
+RETURN c.sctid AS id, node.term AS term, hit.score AS score
+ORDER BY score DESC
+"""
+
+async def ann_search(embedding, index):
+    """Top-k from the in-process HNSW index, resolved to Concepts by Memgraph.
+    Returns None unless every hit resolves, so a stale index falls back to vector_search."""
+    # hnswlib releases the GIL during the search, so it runs off the event loop like the semantic cache
+    labels, distances = await run_in_threadpool(
+        index.knn_query, embedding, k=min(LOOKUP_K, index.get_current_count())
+    )
+    # hnswlib's 'ip' distance is 1 - inner product
+    hits = [{"id": str(i), "score": float(1.0 - d)} for i, d in zip(labels[0], distances[0])]
+    candidates = await driver.execute_query(
+        ANN_RESOLVE_QUERY, {"hits": hits},
+        routing_=RoutingControl.READ, result_transformer_=AsyncResult.data
+    )
+    if len(candidates) < len(hits):
+        logger.warning(f"ANN index is stale ({len(candidates)}/{len(hits)} hits resolved), using vector_search.")
+        return None
+    return candidates
+
+MIN_SYMPTOM_LENGTH = 3
+# Filler a caller can say without naming a symptom - not worth an encode or a DB round-trip
+STOPWORDS = {"a", "an", "and", "the", "i", "im", "i'm", "my", "me", "it", "is", "have", "got",
+             "feel", "feeling", "some", "of", "in", "on", "um", "uh", "erm", "hmm", "yes", "no", "ok", "okay"}
+
+def normalize_symptom(text):
+    """Lowercases and collapses whitespace so "Chest  pain" and "chest pain" share a cache entry;
+    str() because tool-call args come from the LLM and aren't always strings"""
+    return " ".join(str(text).lower().split())
+
+def is_blank_symptom(key):
+    return len(key) < MIN_SYMPTOM_LENGTH or all(word in STOPWORDS for word in key.split())
+
+async def lookup_symptom(symptom_text):
     """Generates embedding and searches Memgraph"""
-    logger.info(f"🔎 Embedding and searching for: '{symptom_text}'")
+    key = normalize_symptom(symptom_text)
+    if is_blank_symptom(key):
+        logger.info(f"Skipping lookup for blank/too-short symptom: '{symptom_text}'")
+        return []
+
+    logger.info(f"🔎 Embedding and searching for: '{key}'")
+    candidates = exact_cache_get(key)
+    if candidates is not None:
+        logger.info("Exact cache hit.")
+        return candidates
+
     try:
         # 1. Generate Embedding
-        embedding = model.encode(symptom_text).tolist()
-        
-        # 2. Search Memgraph (Using MAGE vector_search)
-        query = """
-        CALL vector_search.search('snomed_description_index', 10, $embedding) 
-        YIELD node, similarity 
-        MATCH (c:Concept)-[:HAS_DESCRIPTION]->(node)
-        RETURN c.sctid AS id, node.term AS term, similarity AS score 
-        ORDER BY score DESC
-        """
+        embedding = await get_embedding(key)
+
+        # A full cache is a 10k x 768 GEMV - run it off the event loop (numpy releases the GIL)
+        candidates = await run_in_threadpool(semantic_cache_get, embedding)
+        if candidates is not None:
+            logger.info("Semantic cache hit.")
+            return candidates
         
-        with driver.session() as session:
-            result = session.run(query, embedding=embedding)
-            # Parse results into a clean list
-            candidates = [
-                {"id": r["id"], "term": r["term"], "score": float(r["score"])} 
-                for r in result
-            ]
-
-            if candidates:
-                top = candidates[0]
-                logger.info(f"Top Match: {top['term']} ({top['score']:.4f})")
-            else:
-                logger.warning("No results returned from DB.")
+        # 2a. In-process ANN when the index is loaded; hits missing after a re-ingest
+        # (before the next reload) fall through to Memgraph
+        candidates = None
+        index = ann_index
+        if index is not None:
+            candidates = await ann_search(embedding, index)
 
+        # 2b. Search Memgraph (Using MAGE vector_search)
+        # execute_query runs a managed read transaction (with retries) on a pooled connection,
+        # so no session is opened or torn down per request
+        # Result.data() builds the {"id", "term", "score"} dicts straight from the RETURN columns;
+        # scores already arrive as floats from MAGE
+        if not candidates:
+            candidates = await driver.execute_query(
+                QUERY, {"k": LOOKUP_K, "embedding": embedding},
+                routing_=RoutingControl.READ, result_transformer_=AsyncResult.data
+            )
+
+        if candidates:
+            top = candidates[0]
+            logger.info(f"Top Match: {top['term']} ({top['score']:.4f})")
+            # Empty results aren't cached so a missing index or data doesn't stick after ingest
+            cache_put(key, embedding, candidates)
+        else:
+            logger.warning("No results returned from DB.")
         return candidates
 
-    except Exception as e:
-        logger.error(f"DB Query Failed: {e}")
-        traceback.print_exc()
+    except Exception:
+        logger.exception("DB Query Failed")
         return []
 
+def parse_k(value):
+    """Requested top-k clamped to 1..STREAM_MAX_K; missing or non-numeric falls back to LOOKUP_K"""
+    try:
+        return max(1, min(int(value), STREAM_MAX_K))
+    except (TypeError, ValueError):
+        return LOOKUP_K
+
+async def stream_records(session, result):
+    """Yields {"results": [...]} a record at a time as they come off the Bolt cursor, so the
+    first candidates reach the client before a large top-k query has finished"""
+    try:
+        yield b'{"results":['
+        first = True
+        async for record in result:
+            if not first:
+                yield b','
+            yield orjson.dumps(record.data())
+            first = False
+        yield b']}'
+    except Exception:
+        # Headers are already sent - log it; the client sees a truncated body
+        logger.exception("Streaming results failed")
+        raise
+    finally:
+        await session.close()
+
 # --- WEBHOOK HANDLER (FIXED) ---
 @app.post("/triage")
 async def triage_webhook(request: Request):
@@ -82,11 +519,26 @@ async def triage_webhook(request: Request):
             # Fallback for manual testing via Postman
             if data.get('symptom'):
                 logger.info("Manual Postman/Curl Request Detected")
-                result = lookup_symptom(data['symptom'])
-                return JSONResponse(content={"results": result})
+                # Larger top-k (e.g. {"symptom": ..., "k": 50}) bypasses the top-10 caches and streams
+                k = parse_k(data.get('k', LOOKUP_K))
+                key = normalize_symptom(data['symptom'])
+                if k > LOOKUP_K and not is_blank_symptom(key):
+                    embedding = await get_embedding(key)
+                    # The query runs before the response starts, so a DB failure is still a 500;
+                    # the session is handed to the generator, which closes it
+                    session = driver.session(default_access_mode="READ")
+                    try:
+                        result = await session.run(QUERY, k=k, embedding=embedding)
+                        await result.peek()
+                    except Exception:
+                        await session.close()
+                        raise
+                    return StreamingResponse(stream_records(session, result), media_type="application/json")
+                result = await lookup_symptom(data['symptom'])
+                return ORJSONResponse(content={"results": result})
             
             logger.info("Received heartbeat/status update (no tool calls).")
-            return JSONResponse(content={"status": "ok"})
+            return ORJSONResponse(content={"status": "ok"})
 
         # 2. PROCESS FIRST TOOL CALL
         call = tool_calls[0]
@@ -97,7 +549,7 @@ async def triage_webhook(request: Request):
         # 3. PARSE ARGUMENTS (Can be dict or JSON string)
         args_raw = function.get('arguments', {})
         if isinstance(args_raw, str):
-            args = json.loads(args_raw)
+            args = orjson.loads(args_raw)
         else:
             args = args_raw
             
@@ -108,27 +560,64 @@ async def triage_webhook(request: Request):
         if name == 'lookup_symptom':
             symptom = args.get('symptom')
             if symptom:
-                search_results = lookup_symptom(symptom)
+                search_results = await lookup_symptom(symptom)
                 
                 # Format exactly as Vapi expects
                 response_data = {
                     "results": [
                         {
                             "toolCallId": call_id,
-                            "result": json.dumps(search_results)  # LLM needs stringified JSON
+                            "result": orjson.dumps(search_results).decode()  # LLM needs stringified JSON
                         }
                     ]
                 }
             else:
                 logger.error("Tool call missing 'symptom' argument.")
 
-        return JSONResponse(content=response_data)
+        return ORJSONResponse(content=response_data)
+
+    except Exception as e:
+        logger.exception("Webhook Error")
+        return ORJSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/embed")
+async def embed(request: Request):
+    """Returns the embedding for {"text": ...} from the already-loaded model (used by test.py)"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return ORJSONResponse(content={"error": "Body must be a JSON object."}, status_code=400)
 
+    # Same normalisation as lookup_symptom, so the vector matches what /triage searches with
+    text = normalize_symptom(data.get('text') or '')
+    if not text:
+        return ORJSONResponse(content={"error": "Missing 'text'."}, status_code=400)
+
+    try:
+        embedding = await get_embedding(text)
     except Exception as e:
-        logger.error(f"Webhook Error: {e}")
-        traceback.print_exc()
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        logger.exception("Embedding Failed")
+        return ORJSONResponse(content={"error": str(e)}, status_code=500)
+    return ORJSONResponse(content={"embedding": embedding.tolist()})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    os.environ["ANN_EPOCH"] = str(time.time())  # inherited by the worker processes
+    # uvloop + httptools where they install (not on Windows); uvicorn's pure-Python defaults otherwise
+    if importlib.util.find_spec("uvloop") and importlib.util.find_spec("httptools"):
+        loop, http = "uvloop", "httptools"
+    else:
+        loop, http = "auto", "auto"
+    # Workers need the app as an import string; no per-request access log
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WORKERS,
+        loop=loop,
+        http=http,
+        access_log=False,
+        log_level="warning"
+    )
\ No newline at end of file
@@ -1,10 +1,16 @@
-from sentence_transformers import SentenceTransformer
+import os
+import sys
+import requests
 
-# Load model
-model = SentenceTransformer('all-mpnet-base-v2')
+# Reuses the running server's model instead of loading MPNet for a single encode
+SERVER_URL = os.getenv("TRIAGE_URL", "http://localhost:8000")
+text = sys.argv[1] if len(sys.argv) > 1 else "sharp chest pain"
 
 # Generate Vector
-vector = model.encode("sharp chest pain").tolist()
+response = requests.post(f"{SERVER_URL}/embed", json={"text": text}).json()
+if "embedding" not in response:
+    sys.exit(f"Server error: {response.get('error', response)}")
+vector = response["embedding"]
 
 # Print it formatted for Cypher
-print(str(vector))
\ No newline at end of file
+print(str(vector))